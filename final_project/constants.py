@@ -3,7 +3,12 @@ import os
 # folder paths
 IMAGES_FOLDER_PATH = os.path.join('data', 'dataset')
 LABELS_PATH_FULL = os.path.join('data', 'data.csv')
-LABELS_PATH_CROPPED = os.path.join('data', 'data_cropped.csv')
+LABELS_PATH_FULL_PARQUET = os.path.join('data', 'data.parquet')
+LABELS_PATH_CROPPED = os.path.join('data', 'data_cropped.parquet')
+
+# memory-mapped caches of the preprocessed images (colour and greyscale)
+IMAGES_CACHE_PATH = os.path.join('data', 'images.dat')
+IMAGES_GREY_CACHE_PATH = os.path.join('data', 'images_grey.dat')
 
 
 LABEL_ENCODE_DICT = {'Happy': 0, 'Sad': 1, 'Angry': 2, 'Surprise': 3, 'Neutral': 4}
@@ -1,11 +1,18 @@
 import os
 import shutil
+import struct
+import numpy as np
 import pandas as pd
+import pyarrow.csv as pv
 from tqdm import tqdm
 from PIL import Image
 import subprocess
+import multiprocessing
+from functools import partial
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-from constants import IMAGES_FOLDER_PATH, LABELS_PATH_FULL, LABELS_PATH_CROPPED, LABEL_ENCODE_DICT
+from constants import IMAGES_FOLDER_PATH, LABELS_PATH_FULL, LABELS_PATH_FULL_PARQUET, LABELS_PATH_CROPPED, LABEL_ENCODE_DICT
 
 def remove_emotion_folder(dataset_folder_path, emotion, labels_csv_file):
     """Removes the folder for the specified emotion and its records from the CSV file.
@@ -25,9 +32,10 @@ def remove_emotion_folder(dataset_folder_path, emotion, labels_csv_file):
         print(f"Removed [{emotion}] folder.")
 
     # Filter out rows with 'ahegao' in the 'emotion' column
-    df = pd.read_csv(labels_csv_file)
+    # (pyarrow's multithreaded csv reader is much faster than pd.read_csv)
+    df = pv.read_csv(labels_csv_file).to_pandas()
     df = df[df['label'] != emotion]
-    df.to_csv(labels_csv_file, index=False)
+    df.to_csv(labels_csv_file, index=False, chunksize=100000)
 
     print(f"Removed [{emotion}] records from the CSV file.")
     return None
@@ -49,59 +57,161 @@ def flatten_data_folder(dataset_folder_path):
     flattened_folder_path = os.path.join(dataset_folder_path)
     os.makedirs(flattened_folder_path, exist_ok=True)
 
-    # Iterate through each emotion subfolder
-    for emotion_folder in os.listdir(dataset_folder_path):
-        emotion_folder_path = os.path.join(dataset_folder_path, emotion_folder)
+    # Iterate through each emotion subfolder (listed up front, as images get moved into this folder)
+    with os.scandir(dataset_folder_path) as entries:
+        emotion_folders = [entry for entry in entries if entry.is_dir()]
 
-        # Skip if the path is not a directory
-        if not os.path.isdir(emotion_folder_path):
-            continue
+    for emotion_folder_entry in emotion_folders:
+        emotion_folder = emotion_folder_entry.name
+        emotion_folder_path = emotion_folder_entry.path
+
+        # Iterate through each image file in the emotion subfolder, in inode order
+        # so that the files are read roughly sequentially from disk
+        with os.scandir(emotion_folder_path) as entries:
+            image_entries = sorted(entries, key=lambda entry: entry.inode())
 
-        # Iterate through each image file in the emotion subfolder
-        for image_file in os.listdir(emotion_folder_path):
-            image_file_path = os.path.join(emotion_folder_path, image_file)
-            destination_path = os.path.join(flattened_folder_path, image_file)
+        for image_entry in image_entries:
+            image_file_path = image_entry.path
+            destination_path = os.path.join(flattened_folder_path, image_entry.name)
 
-            # Skip if this image has already been copied to the root destination folder
+            # Drop the duplicate if this image is already in the root destination folder
             if os.path.exists(destination_path):
+                os.remove(image_file_path)
                 continue
 
-            # Copy the image file to the root folder
-            shutil.copy(image_file_path, destination_path)
+            # Move the image file to the root folder (a rename, so no bytes are copied)
+            try:
+                os.replace(image_file_path, destination_path)
+            except OSError:
+                # e.g. source and destination on different filesystems
+                shutil.copy(image_file_path, destination_path)
+                os.remove(image_file_path)
 
-        # Finally, remove the emotion folder
+        # Finally, remove the (now empty) emotion folder
         if os.path.isdir(emotion_folder_path):
-            shutil.rmtree(emotion_folder_path)
+            os.rmdir(emotion_folder_path)
             print(f"Moved images from '{emotion_folder}' folder into {flattened_folder_path}.")
     return None
 
 
 
 
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...) carry the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_dim(f):
+    """ Scans the JPEG segment headers of an open file (positioned just after the
+        SOI marker) until a start-of-frame segment is found. Returns (width, height),
+        or None if no frame header could be read.
+    """
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        # markers may be padded with any number of 0xFF fill bytes
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+
+        # standalone markers have no length field
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+
+        segment_length = f.read(2)
+        if len(segment_length) != 2:
+            return None
+        segment_length = struct.unpack('>H', segment_length)[0]
+
+        if marker in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) != 5:
+                return None
+            height, width = struct.unpack('>xHH', frame)
+            return width, height
+
+        f.seek(segment_length - 2, os.SEEK_CUR)
+
+
+def fast_dim(image_path):
+    """ Returns the (width, height) of a JPEG or PNG file by reading only its header
+        bytes. Returns None for other formats or headers that can't be parsed.
+    """
+    with open(image_path, 'rb') as f:
+        signature = f.read(4)
+        if signature[:2] == b'\xff\xd8':
+            f.seek(2)
+            return _jpeg_dim(f)
+        if signature == b'\x89PNG':
+            # 8-byte signature, then the IHDR chunk: length, type, width, height
+            header = f.read(20)
+            if len(header) == 20 and header[8:12] == b'IHDR':
+                return struct.unpack('>II', header[12:20])
+    return None
+
+
+def get_image_dim(image_path):
+    """ Returns the (width, height) of an image file, or (None, None) if the
+        file does not exist.
+    """
+    if not os.path.isfile(image_path):
+        print(f"Warning: Image not found at {image_path}")
+        return None, None
+
+    dims = fast_dim(image_path)
+    if dims is not None:
+        return dims
+
+    # fall back to PIL for other formats; it only parses the header here
+    with Image.open(image_path) as img:
+        return img.size
+
+
+
+
+def _image_dim_in_folder(image_folder_path, image_path):
+    """ Returns the (width, height) of an image in image_folder_path, or (-1, -1)
+        if it could not be found.
+    """
+    width, height = get_image_dim(os.path.join(image_folder_path, image_path))
+    if width is None:
+        return -1, -1
+    return width, height
+
+
+
+
 def add_pixel_dimensions(df):
     """ Adds columns for image pixel width and pixel height for each image
-        in the labels dataframe.
+        in the labels dataframe. Images that can't be found get a width and
+        height of -1.
     """
     # for error catching in case you run this twice
     if 'width' in df.columns and 'height' in df.columns:
         df = df.drop(columns=['width', 'height'])
 
     image_folder_path = os.path.join('data', 'dataset')
-    widths = []
-    heights = []
-
-    # use tqdm to make a progress bar while it works through the df (without the timer part of the bar)
-    for index, row in tqdm(df.iterrows(), total=df.shape[0]):
-        image_path = os.path.join(image_folder_path, row['path'])
-        if os.path.isfile(image_path):
-            with Image.open(image_path) as img:
-                dims = img.size
-                widths.append(dims[0])
-                heights.append(dims[1])
-        else:
-            widths.append(None)
-            heights.append(None)
-            print(f"Warning: Image not found at {image_path}")
+    paths = df['path'].to_numpy(dtype=object)
+    n = len(paths)
+
+    widths = np.empty(n, dtype=np.int32)
+    heights = np.empty(n, dtype=np.int32)
+
+    # read the image headers in worker processes; paths are sent in chunks, but
+    # results come back one per image so the progress bar counts images
+    n_workers = os.cpu_count() or 1
+    chunksize = max(1, n // (n_workers * 16))
+    with multiprocessing.Pool(n_workers) as pool:
+        dims = pool.imap(partial(_image_dim_in_folder, image_folder_path), paths, chunksize=chunksize)
+        for i, (width, height) in enumerate(tqdm(dims, total=n)):
+            widths[i] = width
+            heights[i] = height
+
     df['width'] = widths
     df['height'] = heights
     print(" -> Finished adding image dimensions to the dataframes.")
@@ -114,29 +224,77 @@ def clean_up_labels_file(file_path: str, label_dict):
     """ Loads the labels csv file, removes the 'Unnamed: 0' column if it exists, 
         removes the 'emotion' folder from the 'path' column, adds columns for image 
         pixel width and pixel height, encodes the 'label' column, and saves the 
-        updated dataframe to the same csv file.
+        updated dataframe to a parquet file next to the csv file (same name, 
+        .parquet extension). Missing image dimensions are stored as nulls.
     """
     df = pd.read_csv(file_path)
 
-    df['path'] = df['path'].apply(lambda x: x.split('/', 1)[1] if x.find('/') != -1 else x)
+    # keep everything after the first '/' (paths without one are left unchanged)
+    df['path'] = df['path'].str.split('/', n=1).str[-1]
     if 'Unnamed: 0' in df.columns:
         df = df.drop(columns=['Unnamed: 0'])
 
     df = add_pixel_dimensions(df)
     df['label_encoded'] = df['label'].map(label_dict)
-    df.to_csv(file_path, index=False)
+
+    # -1 marks images that weren't found; store those as nulls in the compact dtypes
+    df[['width', 'height']] = df[['width', 'height']].where(df[['width', 'height']] >= 0)
+    df = df.astype({'label': 'category', 'width': 'UInt16', 'height': 'UInt16', 'label_encoded': 'UInt8'})
+    df.to_parquet(os.path.splitext(file_path)[0] + '.parquet', index=False, compression='zstd')
     return None
 
 
 
 def isolate_cropped_images(input_file_path: str, output_file_path: str):
-    """ Loads the labels csv file, filters out the non-cropped images, creates a new 
-        csv file with only the cropped images.
+    """ Loads the labels parquet file, filters out the non-cropped images, creates a new 
+        parquet file with only the cropped images.
     """
-    df = pd.read_csv(input_file_path)
+    df = pd.read_parquet(input_file_path)
     # filter to only include rows with 'cropped_emotion' in the 'path' column
     df = df[df['path'].str.contains('cropped_emotion')]
-    df.to_csv(output_file_path, index=False)
+    df.to_parquet(output_file_path, index=False, compression='zstd')
+    return None
+
+
+
+def _extract_member(zip_file, member, destination_folder_path):
+    """ Writes a single zip member to disk with one read and one write, skipping the
+        per-member path checks and chunked copying that ZipFile.extract does.
+    """
+    with open(os.path.join(destination_folder_path, member.filename), 'wb') as f:
+        f.write(zip_file.read(member))
+    return None
+
+
+
+def extract_zip(zip_file_path, destination_folder_path='.', max_workers=8):
+    """ Extracts all files from a zip archive, using a thread pool to write
+        the members concurrently.
+    """
+    destination_root = os.path.abspath(destination_folder_path)
+
+    with zipfile.ZipFile(zip_file_path) as zip_file:
+        files = []
+        folders = set()
+        for member in zip_file.infolist():
+            # Refuse member names that would land outside the destination folder
+            target_path = os.path.abspath(os.path.join(destination_root, member.filename))
+            if os.path.commonpath([destination_root, target_path]) != destination_root:
+                raise ValueError(f"Unsafe path in zip file: {member.filename}")
+
+            if member.is_dir():
+                folders.add(target_path)
+            else:
+                folders.add(os.path.dirname(target_path))
+                files.append(member)
+
+        # Create the folder structure up front so the workers only open and write files
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(tqdm(executor.map(lambda m: _extract_member(zip_file, m, destination_root), files),
+                      total=len(files)))
     return None
 
 
@@ -158,7 +316,7 @@ def download_unzip_kaggle_data():
         
         # Unzip the downloaded dataset
         if os.path.exists('emotion-recognition-dataset.zip'):
-            subprocess.run(['unzip', 'emotion-recognition-dataset.zip'], check=True)
+            extract_zip('emotion-recognition-dataset.zip')
         else:
             raise FileNotFoundError("Downloaded zip file not found.")
         
@@ -187,4 +345,4 @@ if __name__ == "__main__":
     # remove_emotion_folder(IMAGES_FOLDER_PATH, 'Neutral', LABELS_PATH_FULL)
     flatten_data_folder(IMAGES_FOLDER_PATH)
     clean_up_labels_file(LABELS_PATH_FULL, LABEL_ENCODE_DICT) # Note this step takes a while as it opens every image file to record its dimensions.
-    isolate_cropped_images(LABELS_PATH_FULL, LABELS_PATH_CROPPED)
+    isolate_cropped_images(LABELS_PATH_FULL_PARQUET, LABELS_PATH_CROPPED)
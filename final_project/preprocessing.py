@@ -1,111 +1,175 @@
 import os
-from tqdm import tqdm
+import hashlib
 import pandas as pd
 import numpy as np
 import tensorflow as tf
-from keras.utils import load_img, img_to_array #type: ignore
-from PIL import Image
 from constants import IMAGE_SIZE
 
 
-def convert_to_greyscale_pil(image):
-    """
-    Convert a colored image to greyscale using PIL.
-    Args:
-        image (PIL.Image.Image): Input colored image.
-    Returns:
-        PIL.Image.Image: Greyscale image.
-    """
-    greyscale_image = image.convert('L')
-    return greyscale_image
-
-
-
 def image_crop_and_resize(image_array, target_size):
     """
-    Crop and resize an image (input as an array) to a target size.
+    Crop and resize an image of shape (H, W, C), or a batch of same-sized images of
+    shape (N, H, W, C), to a target size. Uses TF ops only, so it can also run inside
+    a tf.data pipeline.
     """
     # Calculate cropping dimensions to maintain the target aspect ratio
-    h1, w1 = image_array.shape[0], image_array.shape[1]
+    image_shape = tf.shape(image_array)
+    h1, w1 = image_shape[-3], image_shape[-2]
     target_aspect = target_size[1] / target_size[0]
-    aspect = w1 / h1
+    aspect = tf.cast(w1, tf.float64) / tf.cast(h1, tf.float64)
 
-    if aspect > target_aspect:
-        new_width = int(target_aspect * h1)
-        new_height = h1
-    else:
-        new_width = w1
-        new_height = int(w1 / target_aspect)
+    new_width = tf.where(aspect > target_aspect, tf.cast(target_aspect * tf.cast(h1, tf.float64), tf.int32), w1)
+    new_height = tf.where(aspect > target_aspect, h1, tf.cast(tf.cast(w1, tf.float64) / target_aspect, tf.int32))
 
     # Calculate cropping box
     left = (w1 - new_width) // 2
     top = (h1 - new_height) // 2
-    right = left + new_width
-    bottom = top + new_height
 
-    # Crop the image
+    # Crop the image(s)
     image_cropped = tf.image.crop_to_bounding_box(image_array, top, left, new_height, new_width)
 
-    # Resize the cropped image
+    # Resize the cropped image(s)
     image_resized = tf.image.resize(image_cropped, target_size)
 
     return image_resized
 
 
 
-def preprocess_data_part1(labels_df, IMAGE_PATH, target_size = IMAGE_SIZE, greyscale = False):
+def load_image(image_path, greyscale = False):
+    """
+    Read and decode an image file into a float32 tensor of shape (height, width, 3),
+    or (height, width, 1) if greyscale = True.
+    """
+    contents = tf.io.read_file(image_path)
+    if not greyscale:
+        image = tf.io.decode_image(contents, channels=3, expand_animations=False)
+        return tf.cast(image, tf.float32)
+
+    # JPEG and PNG can be decoded straight to a single channel; other formats (BMP, GIF)
+    # only decode to RGB, so convert those afterwards
+    is_jpeg_or_png = tf.logical_or(tf.io.is_jpeg(contents),
+                                   tf.equal(tf.strings.substr(contents, 0, 4), b'\x89PNG'))
+    image = tf.cond(is_jpeg_or_png,
+                    lambda: tf.io.decode_image(contents, channels=1, expand_animations=False),
+                    lambda: tf.image.rgb_to_grayscale(
+                        tf.io.decode_image(contents, channels=3, expand_animations=False)))
+    return tf.cast(image, tf.float32)
+
+
+
+def make_image_dataset(labels_df, IMAGE_PATH, target_size = IMAGE_SIZE, greyscale = False, batch_size = 64):
+    """ Build a tf.data pipeline that reads, decodes, crops and resizes the images
+    in parallel.
+
+    Params:
+    -------
+    labels_df (pd.DataFrame): Dataframe with labels and paths to images.
+    IMAGE_PATH (str): Path to directory with the images.
+
+    Returns:
+    --------
+    ds (tf.data.Dataset): Batches of (images, labels), with uint8 images of shape
+                          (batch_size, target_height, target_width, 3), or 1 channel if greyscale = True
+    """
+    paths = [os.path.join(IMAGE_PATH, img_path) for img_path in labels_df['path']]
+    labels = labels_df['label_encoded'].to_numpy().flatten()
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(lambda path, label: (load_image(path, greyscale), label),
+                num_parallel_calls=tf.data.AUTOTUNE)
+    # store pixels as uint8 (rounded back to 0-255) to keep memory use 4x lower than float32
+    ds = ds.map(lambda image, label: (tf.saturate_cast(tf.round(image_crop_and_resize(image, target_size)), tf.uint8), label),
+                num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+
+def _image_cache_key(labels_df, IMAGE_PATH, target_size, greyscale):
+    """
+    Build a key identifying the inputs of a preprocessed image cache: a hash of the
+    image paths (in order), plus the target size and greyscale setting.
+    """
+    paths_hash = hashlib.sha256()
+    for img_path in labels_df['path']:
+        paths_hash.update(os.path.join(IMAGE_PATH, img_path).encode() + b'\n')
+    return f"{paths_hash.hexdigest()} {tuple(target_size)} greyscale={greyscale}"
+
+
+
+def preprocess_data_part1(labels_df, IMAGE_PATH, target_size = IMAGE_SIZE, greyscale = False, cache_path = None):
     """ Generate lists of images as numpy arrays and labels.
     
     Params:
     -------
     IMAGE_PATH (str): Path to directory with the images.
     labels_df (pd.DataFrame): Dataframe with labels and paths to images.
+    cache_path (str): Optional path of a file to memory-map the images to, e.g. 'data/images.dat'.
+                      A key file (cache_path + '.key') records the image paths, target_size and
+                      greyscale setting; if they match, the cached images are reused and the
+                      decode/resize pipeline is skipped. Otherwise the cache is rebuilt.
     
     Returns:
     --------
-    X (np.ndarray): Array of keras img objects. Images of shape (N, target_height, target_width, 3)
+    X (np.ndarray): uint8 array of images of shape (N, target_height, target_width, 3)
                     If greyscale = True, then shape is (N, target_height, target_width, 1)
+                    (an np.memmap if cache_path is given)
     y (np.ndarray): Labels of shape (N,)
     """
-
-    images = []
-    labels = []
-
-    # Create lists of images and labels
-    for idx, row in labels_df.iterrows():
-        img_path = row['path']
-        label = row['label_encoded']
-
-        # Add label to output list of y
-        labels.append(label)
-
-        # Read image
-        img = load_img(os.path.join(IMAGE_PATH, img_path))
-        img_array = img_to_array(img)
-
-        # if greyscale
-        if greyscale:
-            img_pil = Image.fromarray(img_array.astype('uint8'))
-            img_pil = convert_to_greyscale_pil(img_pil)
-            img_array = img_to_array(img_pil)
-            img_array = img_array.reshape((img_array.shape[0], img_array.shape[1], 1))  # Add channel dimension
-        
-        # Crop and resize the image
-        img_array = image_crop_and_resize(img_array, target_size=target_size)
-        
-        # Append to images list
-        images.append(img_array)
-    
-    # Stack images and transform to array
-    images = np.stack(images)
-    labels = np.array(labels).flatten()
+    labels = labels_df['label_encoded'].to_numpy().flatten()
+    images_shape = (len(labels_df), target_size[0], target_size[1], 1 if greyscale else 3)
+
+    if cache_path is not None:
+        cache_key = _image_cache_key(labels_df, IMAGE_PATH, target_size, greyscale)
+        key_path = cache_path + '.key'
+
+        # Reuse previously preprocessed images if they were built from the same inputs
+        if os.path.isfile(cache_path) and os.path.isfile(key_path) \
+                and os.path.getsize(cache_path) == np.prod(images_shape):
+            with open(key_path) as f:
+                if f.read() == cache_key:
+                    images = np.memmap(cache_path, dtype=np.uint8, mode='r', shape=images_shape)
+                    return images, labels
+
+    ds = make_image_dataset(labels_df, IMAGE_PATH, target_size=target_size, greyscale=greyscale)
+
+    # Write the batches into a single array (on disk if cache_path is given). The cache is
+    # written to a temporary file and only moved into place once every image is in it.
+    if cache_path is not None:
+        images = np.memmap(cache_path + '.tmp', dtype=np.uint8, mode='w+', shape=images_shape)
+    else:
+        images = np.empty(images_shape, dtype=np.uint8)
+
+    try:
+        i = 0
+        for image_batch, _ in ds:
+            images[i:i + len(image_batch)] = image_batch.numpy()
+            i += len(image_batch)
+    except BaseException:
+        # don't leave a partially written, full-size temporary cache file behind
+        if cache_path is not None:
+            del images
+            os.remove(cache_path + '.tmp')
+        raise
+
+    if cache_path is not None:
+        images.flush()
+        del images
+        # drop the old key first, so a crash here can't pair it with the new images
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        os.replace(cache_path + '.tmp', cache_path)
+        with open(key_path, 'w') as f:
+            f.write(cache_key)
+        images = np.memmap(cache_path, dtype=np.uint8, mode='r', shape=images_shape)
     
     return images, labels
 
 
 
 def data_split_and_augment(images, labels, splits):
-    """ Split data into train, validation and test sets; apply augmentations
+    """ Split data into train, validation and test sets; apply augmentations.
+    Images are kept as uint8 and are not rescaled.
+
     Params:
     -------
     images  (np.ndarray): Images of shape (N, 224, 224, 3)
@@ -135,8 +199,7 @@ def data_split_and_augment(images, labels, splits):
     y_train, y_val, y_test = np.split(labels, [split_points[0], split_points[1]])
     
     # image augmentation (random flip) on training data
-    X_train_augm = np.array(tf.image.random_flip_left_right(X_train))
-    X_train_augm = np.array(X_train_augm)
+    X_train_augm = tf.image.random_flip_left_right(X_train).numpy().astype(np.uint8)
 
     # concatenate original X_train and augmented X_train_augm data (will double the count of images)
     X_train = np.concatenate([X_train, X_train_augm], axis=0)
@@ -150,10 +213,8 @@ def data_split_and_augment(images, labels, splits):
     X_train = X_train[indices]
     y_train = y_train[indices]
 
-    # rescale training, val, and test images by dividing each pixel by 255.0
-    X_train = X_train / 255.0
-    X_val = X_val / 255.0
-    X_test = X_test / 255.0
+    # NOTE: images are left as uint8 (0-255); rescale inside the model with
+    # tf.keras.layers.Rescaling(1./255) so the arrays don't quadruple in size as float32
     
     return X_train, y_train, X_val, y_val, X_test, y_test
 